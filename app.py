@@ -2,10 +2,16 @@
 Pearlite Phase Analyser - Professional Web Application
 """
 
+from __future__ import annotations
+
 import streamlit as st
 from PIL import Image
 from io import BytesIO
-import base64
+from pathlib import Path
+import hashlib
+import os
+import tempfile
+import uuid
 import streamlit.components.v1 as components
 
 st.set_page_config(
@@ -15,13 +21,86 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-def image_to_base64(img):
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode()
+# Largest size the micrograph is displayed (and painted) at
+MAX_DISPLAY_W, MAX_DISPLAY_H = 900, 600
+
+# Resized micrographs are published through Streamlit's static file server
+# (server.enableStaticServing) so the browser fetches and caches them by URL.
+# The directory is public, so only the most recently used files are kept.
+STATIC_CACHE_DIR = Path(__file__).parent / "static" / "cache"
+MAX_CACHED_IMAGES = 32
+
+# Keyed on the upload's digest: Streamlit does not hash underscore-prefixed
+# arguments, so the bytes are not hashed a second time on every rerun
+@st.cache_data(max_entries=8, show_spinner=False)
+def _display_geometry(digest: str, max_w: int, max_h: int, _file_bytes: bytes) -> tuple[str, int, int]:
+    """Return (cache file name, width, height) of an upload's display copy."""
+    img = Image.open(BytesIO(_file_bytes))
+    scale = min(max_w/img.width, max_h/img.height, 1.0)
+    cw, ch = int(img.width * scale), int(img.height * scale)
+    return f"{digest}_{cw}x{ch}.jpg", cw, ch
+
+def _write_display(file_bytes: bytes, path: Path, cw: int, ch: int) -> None:
+    """Resize an upload to (cw, ch) and publish it at path."""
+    img = Image.open(BytesIO(file_bytes))
+    # Grayscale micrographs stay single-channel: a third of the resize
+    # and encode work and a smaller file than the same pixels as RGB
+    mode = "L" if Image.getmodebase(img.mode) == "L" else "RGB"
+    # JPEG can decode straight at 1/2, 1/4 or 1/8 scale; no-op for others
+    img.draft(mode, (cw * 2, ch * 2))
+    display_img = img.convert(mode)
+    # Integer box reduction down to ~2x the target, then Lanczos for the
+    # final fractional step, so Lanczos never runs over the full upload
+    factor = min(display_img.width // (cw * 2), display_img.height // (ch * 2))
+    if factor > 1:
+        display_img = display_img.reduce(factor)
+    # Uploads that already fit the display (scale 1.0) are used as decoded
+    if display_img.size != (cw, ch):
+        display_img = display_img.resize((cw, ch), Image.Resampling.LANCZOS)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Sessions are threads of one process, so the temp name must be unique
+    # per call, not per pid
+    tmp = tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False)
+    try:
+        with tmp:
+            # Opaque photographic content: JPEG encodes far faster and smaller than PNG
+            display_img.save(tmp, format="JPEG", quality=85, optimize=False, progressive=False)
+        os.replace(tmp.name, path)
+    except OSError:
+        # Another session may have published the same image meanwhile
+        if not path.exists():
+            raise
+    finally:
+        Path(tmp.name).unlink(missing_ok=True)
+
+def _prune_cache(keep: int) -> None:
+    """Delete all but the `keep` most recently used cached images."""
+    def mtime(p: Path) -> float:
+        try:
+            return p.stat().st_mtime
+        except FileNotFoundError:
+            return 0.0
+    # Skip .tmp files: other sessions may still be writing them
+    files = [p for p in STATIC_CACHE_DIR.iterdir() if p.suffix != ".tmp"]
+    for old in sorted(files, key=mtime, reverse=True)[keep:]:
+        # Another session may have removed it already
+        old.unlink(missing_ok=True)
+
+def _prepare_display(file_bytes: bytes, digest: str, max_w: int, max_h: int) -> tuple[str, int, int, int]:
+    """Return (image_path, width, height, total_px), writing the display copy if needed."""
+    name, cw, ch = _display_geometry(digest, max_w, max_h, _file_bytes=file_bytes)
+    path = STATIC_CACHE_DIR / name
+    try:
+        # Mark as recently used so pruning removes idle images first
+        os.utime(path)
+    except FileNotFoundError:
+        # First view, or the file was pruned or cleaned while still memoized
+        _write_display(file_bytes, path, cw, ch)
+        _prune_cache(MAX_CACHED_IMAGES)
+    return f"app/static/cache/{name}", cw, ch, cw * ch
 
 # Professional CSS styling - Grey/White theme
-st.markdown("""
+APP_CSS = """
 <style>
     /* Hide Streamlit branding */
     #MainMenu {visibility: hidden;}
@@ -144,7 +223,16 @@ st.markdown("""
         background: #6b7280 !important;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# Painting canvas: a static bidirectional component loaded once per session;
+# reruns only send it new arguments
+_canvas_component = components.declare_component(
+    "pearlite_canvas", path=str(Path(__file__).parent / "frontend")
+)
+
+# Streamlit drops elements not re-emitted on a rerun, so the CSS is sent every time
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # Header
 st.markdown("""
@@ -194,328 +282,32 @@ uploaded = st.file_uploader(
 )
 
 if uploaded:
-    # Track image to detect new uploads
-    current_image_key = f"{uploaded.name}_{uploaded.size}"
+    # Read the upload once; its content hash identifies the image across reruns
+    raw = uploaded.getvalue()
+    current_image_key = hashlib.blake2b(raw, digest_size=8).hexdigest()
     
+    # A new canvas id is issued only on a new upload or Clear. The canvas
+    # discards saved paint from any other id; any other change reaches the
+    # live frame as new arguments without reloading it.
     if 'last_image_key' not in st.session_state or st.session_state.last_image_key != current_image_key:
         st.session_state.last_image_key = current_image_key
-        st.session_state.clear_canvas = True
+        st.session_state.canvas_id = uuid.uuid4().hex[:12]
     
     if clear_canvas:
-        st.session_state.clear_canvas = True
-    
-    should_clear = st.session_state.get('clear_canvas', False)
-    if should_clear:
-        st.session_state.clear_canvas = False
-    
-    do_undo = undo_action
-    
-    img = Image.open(uploaded).convert("RGB")
-    max_w, max_h = 900, 600
-    scale = min(max_w/img.width, max_h/img.height, 1.0)
-    cw, ch = int(img.width * scale), int(img.height * scale)
-    display_img = img.resize((cw, ch), Image.Resampling.LANCZOS)
-    img_b64 = image_to_base64(display_img)
-    
-    stroke_color = "rgba(220,50,50,0.7)" if tool == "Brush" else "rgba(0,0,0,0)"
-    eraser_mode = "true" if tool == "Eraser" else "false"
-    total_px = cw * ch
-    clear_js = "localStorage.removeItem('pearliteCanvas'); localStorage.removeItem('pearliteHistory');" if should_clear else ""
-    undo_js = "undoLast();" if do_undo else ""
-    
-    canvas_html = f"""
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&display=swap');
-        
-        * {{
-            font-family: 'Inter', -apple-system, BlinkMacSystemFont, sans-serif;
-            box-sizing: border-box;
-        }}
-        
-        .canvas-wrapper {{
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-            gap: 15px;
-        }}
-        
-        #canvas-container {{
-            position: relative;
-            width: {cw}px;
-            height: {ch}px;
-            border-radius: 8px;
-            overflow: hidden;
-            box-shadow: 0 4px 20px rgba(0,0,0,0.1);
-            border: 1px solid #e5e7eb;
-        }}
-        
-        #bgImage {{
-            position: absolute;
-            top: 0;
-            left: 0;
-            width: {cw}px;
-            height: {ch}px;
-            z-index: 1;
-        }}
-        
-        #drawCanvas {{
-            position: absolute;
-            top: 0;
-            left: 0;
-            z-index: 2;
-            cursor: crosshair;
-        }}
-        
-        .results-panel {{
-            width: {cw}px;
-            background: #ffffff;
-            border-radius: 10px;
-            padding: 20px 25px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            box-shadow: 0 2px 8px rgba(0,0,0,0.06);
-            border: 1px solid #e5e7eb;
-        }}
-        
-        .result-main {{
-            text-align: left;
-            flex-shrink: 0;
-        }}
-        
-        .result-label {{
-            color: #6b7280;
-            font-size: 12px;
-            font-weight: 500;
-            text-transform: uppercase;
-            letter-spacing: 0.5px;
-            margin-bottom: 4px;
-        }}
-        
-        .result-value {{
-            color: #1f2937;
-            font-size: 32px;
-            font-weight: 700;
-            line-height: 1;
-        }}
-        
-        .result-details {{
-            text-align: right;
-            flex-shrink: 0;
-        }}
-        
-        .detail-row {{
-            color: #6b7280;
-            font-size: 13px;
-            margin: 3px 0;
-        }}
-        
-        .detail-value {{
-            color: #374151;
-            font-weight: 600;
-        }}
-        
-        .progress-bar {{
-            width: {cw}px;
-            height: 6px;
-            background: #e5e7eb;
-            border-radius: 3px;
-            overflow: hidden;
-        }}
-        
-        .progress-fill {{
-            height: 100%;
-            background: #6b7280;
-            border-radius: 3px;
-            transition: width 0.3s ease;
-            width: 0%;
-        }}
-        
-        .toolbar {{
-            width: {cw}px;
-            background: #ffffff;
-            border-radius: 8px;
-            padding: 10px 16px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            box-shadow: 0 2px 8px rgba(0,0,0,0.06);
-            border: 1px solid #e5e7eb;
-        }}
-        
-        .tool-indicator {{
-            display: flex;
-            align-items: center;
-            gap: 10px;
-        }}
-        
-        .tool-badge {{
-            background: {"#fef2f2" if tool == "Brush" else "#f3f4f6"};
-            color: {"#dc2626" if tool == "Brush" else "#374151"};
-            padding: 5px 12px;
-            border-radius: 6px;
-            font-size: 12px;
-            font-weight: 600;
-        }}
-        
-        .size-indicator {{
-            color: #6b7280;
-            font-size: 12px;
-        }}
-        
-        .image-name {{
-            color: #9ca3af;
-            font-size: 12px;
-            max-width: 180px;
-            overflow: hidden;
-            text-overflow: ellipsis;
-            white-space: nowrap;
-        }}
-    </style>
-    
-    <div class="canvas-wrapper">
-        <div class="toolbar">
-            <div class="tool-indicator">
-                <span class="tool-badge">{"🖌️ Brush" if tool == "Brush" else "🧹 Eraser"}</span>
-                <span class="size-indicator">Size: {brush_size}px</span>
-            </div>
-            <span class="image-name">📁 {uploaded.name}</span>
-        </div>
-        
-        <div id="canvas-container">
-            <img id="bgImage" src="data:image/png;base64,{img_b64}">
-            <canvas id="drawCanvas" width="{cw}" height="{ch}"></canvas>
-        </div>
-        
-        <div class="progress-bar">
-            <div class="progress-fill" id="progressFill"></div>
-        </div>
-        
-        <div class="results-panel">
-            <div class="result-main">
-                <div class="result-label">Pearlite Fraction</div>
-                <div class="result-value" id="percentDisplay">0.00%</div>
-            </div>
-            <div class="result-details">
-                <div class="detail-row">Painted: <span class="detail-value" id="paintedDisplay">0</span> px</div>
-                <div class="detail-row">Total: <span class="detail-value">{total_px:,}</span> px</div>
-            </div>
-        </div>
-    </div>
-    
-    <script>
-    {clear_js}
-    
-    const canvas = document.getElementById('drawCanvas');
-    const ctx = canvas.getContext('2d');
-    let isDrawing = false;
-    let lastX = 0, lastY = 0;
-    let history = [];
-    const maxHistory = 20;
-    
-    ctx.lineCap = 'round';
-    ctx.lineJoin = 'round';
-    ctx.lineWidth = {brush_size};
-    ctx.strokeStyle = '{stroke_color}';
-    ctx.globalCompositeOperation = {eraser_mode} ? 'destination-out' : 'source-over';
-    
-    // Load saved canvas
-    const saved = localStorage.getItem('pearliteCanvas');
-    if (saved) {{
-        const img = new Image();
-        img.onload = function() {{ 
-            ctx.drawImage(img, 0, 0); 
-            updateCount(); 
-            saveToHistory();
-        }};
-        img.src = saved;
-    }}
-    
-    function saveToHistory() {{
-        history.push(canvas.toDataURL());
-        if (history.length > maxHistory) history.shift();
-        localStorage.setItem('pearliteHistory', JSON.stringify(history));
-    }}
-    
-    function undoLast() {{
-        if (history.length > 1) {{
-            history.pop();
-            const lastState = history[history.length - 1];
-            const img = new Image();
-            img.onload = function() {{
-                ctx.clearRect(0, 0, {cw}, {ch});
-                ctx.drawImage(img, 0, 0);
-                localStorage.setItem('pearliteCanvas', canvas.toDataURL());
-                updateCount();
-            }};
-            img.src = lastState;
-        }} else {{
-            ctx.clearRect(0, 0, {cw}, {ch});
-            history = [];
-            localStorage.removeItem('pearliteCanvas');
-            updateCount();
-        }}
-    }}
-    
-    {undo_js}
-    
-    function getPos(e) {{
-        const rect = canvas.getBoundingClientRect();
-        const x = (e.touches ? e.touches[0].clientX : e.clientX) - rect.left;
-        const y = (e.touches ? e.touches[0].clientY : e.clientY) - rect.top;
-        return [x, y];
-    }}
-    
-    function startDraw(e) {{ 
-        isDrawing = true; 
-        [lastX, lastY] = getPos(e); 
-    }}
-    
-    function draw(e) {{
-        if (!isDrawing) return;
-        e.preventDefault();
-        const [x, y] = getPos(e);
-        ctx.beginPath();
-        ctx.moveTo(lastX, lastY);
-        ctx.lineTo(x, y);
-        ctx.stroke();
-        [lastX, lastY] = [x, y];
-    }}
-    
-    function stopDraw() {{
-        if (isDrawing) {{
-            isDrawing = false;
-            localStorage.setItem('pearliteCanvas', canvas.toDataURL());
-            saveToHistory();
-            updateCount();
-        }}
-    }}
-    
-    function updateCount() {{
-        const imageData = ctx.getImageData(0, 0, {cw}, {ch});
-        let count = 0;
-        for (let i = 3; i < imageData.data.length; i += 4) {{
-            if (imageData.data[i] > 50) count++;
-        }}
-        const pct = ((count / {total_px}) * 100);
-        document.getElementById('percentDisplay').textContent = pct.toFixed(2) + '%';
-        document.getElementById('paintedDisplay').textContent = count.toLocaleString();
-        document.getElementById('progressFill').style.width = pct + '%';
-    }}
+        st.session_state.canvas_id = uuid.uuid4().hex[:12]
     
-    canvas.addEventListener('mousedown', startDraw);
-    canvas.addEventListener('mousemove', draw);
-    canvas.addEventListener('mouseup', stopDraw);
-    canvas.addEventListener('mouseout', stopDraw);
-    canvas.addEventListener('touchstart', startDraw);
-    canvas.addEventListener('touchmove', draw);
-    canvas.addEventListener('touchend', stopDraw);
+    if undo_action:
+        st.session_state.undo_seq = st.session_state.get('undo_seq', 0) + 1
     
-    updateCount();
-    </script>
-    """
+    image_path, cw, ch, total_px = _prepare_display(raw, current_image_key, MAX_DISPLAY_W, MAX_DISPLAY_H)
     
-    components.html(canvas_html, height=ch + 220)
+    _canvas_component(
+        image_path=image_path, width=cw, height=ch, total_px=total_px,
+        file_name=uploaded.name, tool=tool, brush_size=brush_size,
+        canvas_id=st.session_state.canvas_id,
+        undo_seq=st.session_state.get('undo_seq', 0),
+        key="pearlite_canvas",
+    )
 
 else:
     # Clean upload prompt